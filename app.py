@@ -3,13 +3,11 @@ import cv2
 import numpy as np
 from PIL import Image
 import datetime
-import face_recognition
-import tempfile
 import os
 
 # Import local modules
 from database import PersonDatabase
-from face_utils import FaceRecognitionSystem
+from face_utils import FaceRecognitionSystem, REGISTRATION_WIDTH
 
 # Page configuration
 st.set_page_config(
@@ -27,6 +25,19 @@ def init_systems():
 
 db, face_system = init_systems()
 
+# Cache the person list shown in the UI; the DB version invalidates it on changes
+@st.cache_data(ttl=30)
+def _cached_persons(version):
+    return db.get_all_persons_lightweight()
+
+@st.cache_data(ttl=30)
+def _cached_recent_persons(version):
+    return db.get_recent_persons(limit=5)
+
+@st.cache_data(ttl=5)
+def _cached_counts(version):
+    return db.get_counts()
+
 # Sidebar navigation
 st.sidebar.title("Navigation")
 page = st.sidebar.radio(
@@ -41,7 +52,7 @@ if page == "🏠 Dashboard":
     col1, col2, col3 = st.columns(3)
     
     with col1:
-        total_persons = len(db.get_all_persons())
+        total_persons, _ = _cached_counts(db.version())
         st.metric("Total Registered Persons", total_persons)
     
     with col2:
@@ -55,15 +66,15 @@ if page == "🏠 Dashboard":
     
     # Recent detections
     st.subheader("Recent Detections")
-    persons = db.get_all_persons()
+    persons = _cached_recent_persons(db.version())
     
     if persons:
         # Show recent persons in a simple list
-        for person in persons[:5]:  # Show first 5
+        for person in persons:
             with st.expander(f"👤 {person['name']}"):
                 st.write(f"**Role:** {person['metadata'].get('role', 'N/A')}")
                 if person['last_seen']:
-                    last_seen = datetime.datetime.fromisoformat(person['last_seen'])
+                    last_seen = datetime.datetime.fromtimestamp(person['last_seen'] / 1000)
                     st.write(f"**Last seen:** {last_seen.strftime('%Y-%m-%d %H:%M')}")
                 st.write(f"**Total detections:** {person['total_detections']}")
     else:
@@ -86,39 +97,48 @@ elif page == "📷 Real-time Detection":
             )
             
             if camera_image:
-                # Convert PIL Image to OpenCV format
+                # Keep the frame in RGB, the order PIL, face_system and st.image all use
                 image = Image.open(camera_image)
-                frame = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
+                frame = np.array(image.convert("RGB"))
                 
-                # Recognize faces
-                recognized_faces = face_system.recognize_faces(frame)
+                # Recognize faces on a downscaled copy to speed up detection
+                scale = min(1.0, 640 / max(frame.shape[:2]))
+                if scale < 1.0:
+                    small_frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+                else:
+                    small_frame = frame
+                recognized_faces = face_system.recognize_faces(small_frame, rgb=True)
                 
-                # Draw boxes on frame
-                annotated_frame = face_system.draw_face_boxes(frame.copy(), recognized_faces)
+                # Scale face locations back up for display and registration
+                recognized_faces['locations'] = (recognized_faces['locations'] / scale).astype(np.int32)
                 
-                # Convert back to RGB for display
-                annotated_image = cv2.cvtColor(annotated_frame, cv2.COLOR_BGR2RGB)
+                # Draw boxes on an RGB copy that can be displayed directly
+                annotated_image = face_system.draw_face_boxes(frame.copy(), recognized_faces)
                 st.image(annotated_image, caption="Detection Results", use_column_width=True)
                 
-                # Process recognized faces
-                for face in recognized_faces:
-                    if face['name'] == "Unknown":
-                        st.warning(f"Unknown face detected! Register this person.")
-                        
-                        # Simple registration form
-                        name = st.text_input("Enter name to register", key=f"name_{face['location']}")
-                        if st.button("Register", key=f"btn_{face['location']}"):
-                            if name:
-                                metadata = {"registered_via": "camera"}
-                                if face_system.register_new_face(frame, name, metadata):
-                                    st.success(f"✅ {name} registered successfully!")
-                                    st.rerun()
-                                else:
-                                    st.error("Failed to register face. Please try again.")
-                    else:
-                        # Log known person detection
-                        db.log_detection(face['person_id'], face['confidence'])
-                        st.success(f"✅ Recognized: {face['name']} (Confidence: {face['confidence']:.2f})")
+                ids = recognized_faces['ids']
+                confidences = recognized_faces['confidences']
+                known = ids >= 0
+                
+                # Log all known person detections for this frame at once
+                db.log_detections(list(zip(ids[known].tolist(), confidences[known].tolist())))
+                for idx in np.flatnonzero(known):
+                    st.success(f"✅ Recognized: {recognized_faces['names'][idx]} (Confidence: {confidences[idx]:.2f})")
+                
+                # Offer registration for unknown faces
+                for location in recognized_faces['locations'][~known].tolist():
+                    st.warning(f"Unknown face detected! Register this person.")
+                    
+                    # Simple registration form
+                    name = st.text_input("Enter name to register", key=f"name_{tuple(location)}")
+                    if st.button("Register", key=f"btn_{tuple(location)}"):
+                        if name:
+                            metadata = {"registered_via": "camera"}
+                            if face_system.register_new_face(frame, name, metadata, rgb=True):
+                                st.success(f"✅ {name} registered successfully!")
+                                st.rerun()
+                            else:
+                                st.error("Failed to register face. Please try again.")
         
         with col2:
             st.subheader("Detection Info")
@@ -136,116 +156,87 @@ elif page == "📷 Real-time Detection":
         )
         
         if uploaded_file:
-            # Save uploaded file temporarily
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as tmp_file:
-                tmp_file.write(uploaded_file.getvalue())
-                temp_path = tmp_file.name
+            # Decode the upload straight from memory; large JPEGs are decoded
+            # at half resolution, which libjpeg does cheaply during the DCT
+            buf = np.frombuffer(uploaded_file.getvalue(), dtype=np.uint8)
+            is_jpeg = os.path.splitext(uploaded_file.name)[1].lower() in ('.jpg', '.jpeg')
+            if is_jpeg and buf.size > 1_500_000:
+                image = cv2.imdecode(buf, cv2.IMREAD_REDUCED_COLOR_2)
+            else:
+                image = cv2.imdecode(buf, cv2.IMREAD_COLOR)
             
-            try:
-                # Load image
-                image = cv2.imread(temp_path)
+            if image is None:
+                st.error("Could not read the image file. Please try another format.")
+            else:
+                # Convert to RGB once; everything below works in RGB
+                rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
                 
-                if image is None:
-                    st.error("Could not read the image file. Please try another format.")
-                else:
-                    # Display original image
-                    st.image(cv2.cvtColor(image, cv2.COLOR_BGR2RGB), 
-                            caption="Uploaded Image", 
+                # Display original image
+                st.image(rgb_image, 
+                        caption="Uploaded Image", 
+                        width=300)
+                
+                # Detect faces at the width registration uses, retrying with
+                # the CNN model if the first pass finds none
+                with st.spinner("Detecting faces..."):
+                    face_locations = face_system.detect_faces(rgb_image, rgb=True, max_width=REGISTRATION_WIDTH)
+                
+                if len(face_locations) > 0:
+                    st.success(f"✅ Found {len(face_locations)} face(s) in the image!")
+                    
+                    # Draw boxes on detected faces
+                    annotated_image = rgb_image.copy()
+                    for (top, right, bottom, left) in face_locations:
+                        cv2.rectangle(annotated_image, (left, top), (right, bottom), (0, 255, 0), 2)
+                    
+                    # Show image with detected faces
+                    st.image(annotated_image, 
+                            caption="Detected Faces", 
                             width=300)
                     
-                    # Check for faces using multiple methods
-                    rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+                    # Registration form
+                    st.subheader("Register Person")
+                    col1, col2 = st.columns(2)
                     
-                    # Method 1: face_recognition library
-                    face_locations = face_recognition.face_locations(rgb_image)
+                    with col1:
+                        name = st.text_input("Full Name", placeholder="Enter person's name")
                     
-                    if len(face_locations) > 0:
-                        st.success(f"✅ Found {len(face_locations)} face(s) in the image!")
-                        
-                        # Draw boxes on detected faces
-                        for (top, right, bottom, left) in face_locations:
-                            cv2.rectangle(image, (left, top), (right, bottom), (0, 255, 0), 2)
-                        
-                        # Show image with detected faces
-                        st.image(cv2.cvtColor(image, cv2.COLOR_BGR2RGB), 
-                                caption="Detected Faces", 
-                                width=300)
-                        
-                        # Registration form
-                        st.subheader("Register Person")
-                        col1, col2 = st.columns(2)
-                        
-                        with col1:
-                            name = st.text_input("Full Name", placeholder="Enter person's name")
-                        
-                        with col2:
-                            role = st.selectbox(
-                                "Role",
-                                ["Visitor", "Employee", "Student", "Guest", "Family", "Other"]
-                            )
-                        
-                        additional_info = st.text_area("Additional Information (optional)")
-                        
-                        if st.button("Register This Person", type="primary"):
-                            if name and name.strip():
-                                metadata = {
-                                    "role": role,
-                                    "additional_info": additional_info,
-                                    "registered_via": "upload",
-                                    "registration_date": datetime.datetime.now().isoformat()
-                                }
-                                
-                                # Try to register
-                                if face_system.register_new_face(image, name.strip(), metadata):
-                                    st.success(f"✅ **{name}** has been successfully registered!")
-                                    st.balloons()
-                                else:
-                                    st.error("❌ Registration failed. The person might already exist or there was an error.")
-                            else:
-                                st.warning("Please enter a name for the person.")
-                    else:
-                        st.warning("⚠️ No faces detected in the uploaded image.")
-                        st.info("""
-                        **Tips for better face detection:**
-                        1. Make sure the face is clearly visible
-                        2. Good lighting is important
-                        3. Face should be facing forward
-                        4. Avoid sunglasses or heavy shadows
-                        5. Try a different image
-                        """)
-                        
-                        # Try alternative method with different model
-                        st.write("Trying alternative detection method...")
-                        
-                        # Resize image for faster processing
-                        small_image = cv2.resize(rgb_image, (0, 0), fx=0.5, fy=0.5)
-                        face_locations = face_recognition.face_locations(small_image, model="cnn")
-                        
-                        if len(face_locations) > 0:
-                            st.success(f"Found {len(face_locations)} face(s) using alternative method!")
-                            
-                            # Scale back up the face locations
-                            for (top, right, bottom, left) in face_locations:
-                                top, right, bottom, left = [coord * 2 for coord in [top, right, bottom, left]]
-                                cv2.rectangle(image, (left, top), (right, bottom), (0, 255, 0), 2)
-                            
-                            st.image(cv2.cvtColor(image, cv2.COLOR_BGR2RGB), 
-                                    caption="Detected Faces (Alternative Method)", 
-                                    width=300)
+                    with col2:
+                        role = st.selectbox(
+                            "Role",
+                            ["Visitor", "Employee", "Student", "Guest", "Family", "Other"]
+                        )
+                    
+                    additional_info = st.text_area("Additional Information (optional)")
+                    
+                    if st.button("Register This Person", type="primary"):
+                        if name and name.strip():
+                            metadata = {
+                                "role": role,
+                                "additional_info": additional_info,
+                                "registered_via": "upload",
+                                "registration_date": datetime.datetime.now().isoformat()
+                            }
                             
-                            # Show registration form
-                            name = st.text_input("Enter name to register")
-                            if st.button("Register This Person"):
-                                if name:
-                                    metadata = {"registered_via": "upload_cnn"}
-                                    if face_system.register_new_face(image, name, metadata):
-                                        st.success(f"✅ {name} registered successfully!")
-                                    else:
-                                        st.error("Registration failed.")
-            finally:
-                # Clean up temporary file
-                if os.path.exists(temp_path):
-                    os.unlink(temp_path)
+                            # Try to register
+                            if face_system.register_new_face(rgb_image, name.strip(), metadata, rgb=True,
+                                                             face_locations=face_locations):
+                                st.success(f"✅ **{name}** has been successfully registered!")
+                                st.balloons()
+                            else:
+                                st.error("❌ Registration failed. The person might already exist or there was an error.")
+                        else:
+                            st.warning("Please enter a name for the person.")
+                else:
+                    st.warning("⚠️ No faces detected in the uploaded image.")
+                    st.info("""
+                    **Tips for better face detection:**
+                    1. Make sure the face is clearly visible
+                    2. Good lighting is important
+                    3. Face should be facing forward
+                    4. Avoid sunglasses or heavy shadows
+                    5. Try a different image
+                    """)
 
 # Manage Database Page
 elif page == "👥 Manage Database":
@@ -256,7 +247,7 @@ elif page == "👥 Manage Database":
     with tab1:
         st.subheader("Registered Persons")
         
-        persons = db.get_all_persons()
+        persons = _cached_persons(db.version())
         
         if persons:
             # Create a table-like display
@@ -270,7 +261,7 @@ elif page == "👥 Manage Database":
                     with col2:
                         st.write(f"**Role:** {person['metadata'].get('role', 'N/A')}")
                         if person['last_seen']:
-                            last_seen = datetime.datetime.fromisoformat(person['last_seen'])
+                            last_seen = datetime.datetime.fromtimestamp(person['last_seen'] / 1000)
                             st.write(f"**Last Seen:** {last_seen.strftime('%Y-%m-%d %H:%M:%S')}")
                         
                         st.write(f"**Registered:** {person['registration_date'][:10]}")
@@ -301,7 +292,7 @@ elif page == "👥 Manage Database":
     with tab3:
         st.subheader("Edit or Delete Persons")
         
-        persons = db.get_all_persons()
+        persons = _cached_persons(db.version())
         
         if persons:
             # Create selectbox for person selection
@@ -339,7 +330,7 @@ elif page == "👥 Manage Database":
                             })
                             
                             db.update_person(person['id'], new_name, metadata)
-                            face_system.load_known_faces()
+                            face_system.update_known(person['id'], name=new_name)
                             st.success(f"✅ {person['name']} updated successfully!")
                             st.rerun()
                     
@@ -348,7 +339,7 @@ elif page == "👥 Manage Database":
                             st.warning(f"Are you sure you want to delete {person['name']}?")
                             if st.button("Yes, Delete Permanently", type="primary"):
                                 db.delete_person(person['id'])
-                                face_system.load_known_faces()
+                                face_system.remove_known(person['id'])
                                 st.success(f"✅ {person['name']} deleted successfully!")
                                 st.rerun()
         else:
@@ -394,16 +385,14 @@ elif page == "⚙️ Settings":
     
     with col2:
         if st.button("📊 View Database Stats", use_container_width=True):
-            persons = db.get_all_persons()
-            if persons:
-                st.write(f"**Total persons:** {len(persons)}")
-                total_detections = sum(p['total_detections'] for p in persons)
+            total_persons, total_detections = _cached_counts(db.version())
+            if total_persons:
+                st.write(f"**Total persons:** {total_persons}")
                 st.write(f"**Total detections:** {total_detections}")
                 
                 # Show most frequently detected
-                sorted_persons = sorted(persons, key=lambda x: x['total_detections'], reverse=True)
                 st.write("**Most frequently detected:**")
-                for person in sorted_persons[:3]:
+                for person in db.get_top_persons(limit=3):
                     st.write(f"- {person['name']}: {person['total_detections']} detections")
             else:
                 st.info("Database is empty.")
@@ -412,7 +401,7 @@ elif page == "⚙️ Settings":
     
     st.subheader("System Information")
     
-    persons = db.get_all_persons()
+    persons = _cached_persons(db.version())
     
     col1, col2, col3 = st.columns(3)
     
@@ -428,16 +417,14 @@ elif page == "⚙️ Settings":
             # Find person with most recent detection
             persons_with_detections = [p for p in persons if p['last_seen']]
             if persons_with_detections:
-                latest = max(persons_with_detections, 
-                           key=lambda x: datetime.datetime.fromisoformat(x['last_seen']))
+                latest = max(persons_with_detections, key=lambda x: x['last_seen'])
                 st.metric("Last Detected", latest['name'])
 
 # Footer
 st.sidebar.divider()
 st.sidebar.markdown("### Quick Stats")
-persons = db.get_all_persons()
-st.sidebar.write(f"👤 **Registered:** {len(persons)}")
-total_detections = sum(p['total_detections'] for p in persons)
+total_persons, total_detections = _cached_counts(db.version())
+st.sidebar.write(f"👤 **Registered:** {total_persons}")
 st.sidebar.write(f"📊 **Total Detections:** {total_detections}")
 st.sidebar.divider()
 st.sidebar.caption("System Status: 🟢 Online")
\ No newline at end of file
@@ -1,206 +1,398 @@
 import sqlite3
 import json
 import datetime
-from typing import List, Optional, Dict, Any, Tuple
+import time
+import numpy as np
+from typing import List, Optional, Dict, Any, Tuple, Union
 import hashlib
+import threading
+from contextlib import contextmanager
+from collections import Counter
+
+try:
+    import orjson
+    _loads = orjson.loads
+    def _dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+except ImportError:
+    _loads = json.loads
+    _dumps = json.dumps
+
+def _load_metadata(raw) -> Dict:
+    """Parse a metadata column value, skipping the parser for empty values"""
+    if not raw or raw == '{}':
+        return {}
+    return _loads(raw)
+
+def _encoding_to_blob(face_encoding) -> bytes:
+    """Serialize a face encoding as raw little-endian float32 bytes, passing bytes through"""
+    if isinstance(face_encoding, (bytes, bytearray, memoryview)):
+        return bytes(face_encoding)
+    return np.ascontiguousarray(face_encoding, dtype='<f4').tobytes()
+
+def _blob_to_encoding(blob: bytes) -> np.ndarray:
+    """Deserialize a little-endian float32 BLOB back into a face encoding"""
+    return np.frombuffer(blob, dtype='<f4')
+
+# last_seen and detection_time are unix timestamps in milliseconds
+_CREATE_PERSONS = '''
+    CREATE TABLE IF NOT EXISTS persons (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        face_encoding BLOB NOT NULL,
+        registration_date TEXT NOT NULL,
+        last_seen INTEGER,
+        total_detections INTEGER DEFAULT 0,
+        metadata TEXT,
+        UNIQUE(name)
+    )
+'''
+
+_CREATE_DETECTION_LOGS = '''
+    CREATE TABLE IF NOT EXISTS detection_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        person_id INTEGER,
+        detection_time INTEGER NOT NULL,
+        confidence REAL,
+        FOREIGN KEY (person_id) REFERENCES persons (id)
+    )
+'''
+
+# One row identifying the stored encodings for cached copies: epoch is set
+# when the database is created, modifications counts renames, re-encodings
+# and deletions. Registrations only add higher ids, so they change neither.
+_CREATE_GALLERY_STATE = '''
+    CREATE TABLE IF NOT EXISTS gallery_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        epoch TEXT NOT NULL,
+        modifications INTEGER NOT NULL DEFAULT 0
+    )
+'''
+
+_GALLERY_TRIGGERS = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS persons_gallery_change AFTER UPDATE OF name, face_encoding ON persons
+    WHEN OLD.name IS NOT NEW.name OR OLD.face_encoding IS NOT NEW.face_encoding
+    BEGIN UPDATE gallery_state SET modifications = modifications + 1; END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS persons_gallery_delete AFTER DELETE ON persons
+    BEGIN UPDATE gallery_state SET modifications = modifications + 1; END
+    ''',
+]
+
+_UPDATE_NAME = "UPDATE persons SET name = ? WHERE id = ?"
+_UPDATE_METADATA = "UPDATE persons SET metadata = ? WHERE id = ?"
+_UPDATE_NAME_AND_METADATA = "UPDATE persons SET name = ?, metadata = ? WHERE id = ?"
 
 class PersonDatabase:
     def __init__(self, db_path: str = "persons.db"):
         self.db_path = db_path
+        self._local = threading.local()
+        self._version = 0
         self.init_database()
     
+    def version(self) -> int:
+        """Get a counter that changes whenever person data is modified"""
+        return self._version
+    
+    def _conn(self) -> sqlite3.Connection:
+        """Get this thread's cached connection, opening it on first use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            conn.execute("PRAGMA mmap_size=268435456")
+            self._local.conn = conn
+        return conn
+    
+    @contextmanager
+    def _transaction(self):
+        """Run the enclosed statements in a single transaction"""
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            yield conn.cursor()
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+    
     def init_database(self):
         """Initialize database with required tables"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Persons table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS persons (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                face_encoding TEXT NOT NULL,
-                registration_date TEXT NOT NULL,
-                last_seen TEXT,
-                total_detections INTEGER DEFAULT 0,
-                metadata TEXT,
-                UNIQUE(name)
+        with self._transaction() as cursor:
+            # Persons table
+            cursor.execute(_CREATE_PERSONS)
+            
+            # Detection logs table
+            cursor.execute(_CREATE_DETECTION_LOGS)
+            
+            # Rebuild tables that older versions created with ISO text timestamps
+            self._migrate_timestamps(cursor)
+            
+            # Convert encodings stored as JSON text by older versions
+            legacy_rows = cursor.execute(
+                "SELECT id, face_encoding FROM persons WHERE typeof(face_encoding) = 'text'"
+            ).fetchall()
+            cursor.executemany(
+                "UPDATE persons SET face_encoding = ? WHERE id = ?",
+                [(_encoding_to_blob(_loads(row['face_encoding'])), row['id']) for row in legacy_rows]
             )
-        ''')
-        
-        # Detection logs table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS detection_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                person_id INTEGER,
-                detection_time TEXT NOT NULL,
-                confidence REAL,
-                FOREIGN KEY (person_id) REFERENCES persons (id)
+            
+            # Gallery state, after any table rebuild so the triggers stick
+            cursor.execute(_CREATE_GALLERY_STATE)
+            cursor.execute(
+                "INSERT OR IGNORE INTO gallery_state (id, epoch) VALUES (1, lower(hex(randomblob(8))))"
             )
-        ''')
+            # Replaced by persons_gallery_change, which skips writes that change nothing
+            cursor.execute("DROP TRIGGER IF EXISTS persons_gallery_update")
+            for trigger in _GALLERY_TRIGGERS:
+                cursor.execute(trigger)
+            
+            # Indexes for the stats queries and name search
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_time ON detection_logs(detection_time DESC)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_person_time ON detection_logs(person_id, detection_time)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_persons_name ON persons(name COLLATE NOCASE)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_persons_detections ON persons(total_detections DESC)")
+    
+    def _migrate_timestamps(self, cursor):
+        """Convert ISO text timestamps from older versions to unix milliseconds"""
+        def to_ms(value):
+            return int(datetime.datetime.fromisoformat(value).timestamp() * 1000) if value else None
+        
+        columns = {row['name']: row['type'] for row in cursor.execute("PRAGMA table_info(persons)")}
+        if columns['last_seen'] == 'TEXT':
+            rows = cursor.execute("SELECT * FROM persons").fetchall()
+            cursor.execute("DROP TABLE persons")
+            cursor.execute(_CREATE_PERSONS)
+            cursor.executemany('''
+                INSERT INTO persons (id, name, face_encoding, registration_date, last_seen, total_detections, metadata)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', [
+                (row['id'], row['name'], row['face_encoding'], row['registration_date'],
+                 to_ms(row['last_seen']), row['total_detections'], row['metadata'])
+                for row in rows
+            ])
         
-        conn.commit()
-        conn.close()
+        columns = {row['name']: row['type'] for row in cursor.execute("PRAGMA table_info(detection_logs)")}
+        if columns['detection_time'] == 'TEXT':
+            rows = cursor.execute("SELECT * FROM detection_logs").fetchall()
+            cursor.execute("DROP TABLE detection_logs")
+            cursor.execute(_CREATE_DETECTION_LOGS)
+            cursor.executemany('''
+                INSERT INTO detection_logs (id, person_id, detection_time, confidence)
+                VALUES (?, ?, ?, ?)
+            ''', [
+                (row['id'], row['person_id'], to_ms(row['detection_time']), row['confidence'])
+                for row in rows
+            ])
     
-    def add_person(self, name: str, face_encoding: List[float], metadata: Dict = None) -> int:
+    def add_person(self, name: str, face_encoding: Union[bytes, np.ndarray, List[float]], metadata: Dict = None) -> int:
         """Add a new person to the database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        row = self._conn().execute('''
+            INSERT INTO persons (name, face_encoding, registration_date, metadata)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(name) DO NOTHING
+            RETURNING id
+        ''', (
+            name,
+            _encoding_to_blob(face_encoding),
+            datetime.datetime.now().isoformat(),
+            _dumps(metadata or {})
+        )).fetchone()
         
-        try:
-            cursor.execute('''
-                INSERT INTO persons (name, face_encoding, registration_date, metadata)
-                VALUES (?, ?, ?, ?)
-            ''', (
-                name,
-                json.dumps(face_encoding),
-                datetime.datetime.now().isoformat(),
-                json.dumps(metadata or {})
-            ))
-            
-            person_id = cursor.lastrowid
-            conn.commit()
-            return person_id
-        except sqlite3.IntegrityError:
+        if row is None:
             raise ValueError(f"Person with name '{name}' already exists")
-        finally:
-            conn.close()
+        
+        self._version += 1
+        return row[0]
     
     def update_person(self, person_id: int, name: str = None, metadata: Dict = None):
         """Update person information"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        updates = []
-        values = []
-        
-        if name:
-            updates.append("name = ?")
-            values.append(name)
-        
-        if metadata is not None:
-            updates.append("metadata = ?")
-            values.append(json.dumps(metadata))
-        
-        if updates:
-            values.append(person_id)
-            cursor.execute(f'''
-                UPDATE persons 
-                SET {', '.join(updates)}
-                WHERE id = ?
-            ''', values)
-            
-        conn.commit()
-        conn.close()
+        if name and metadata is not None:
+            self._conn().execute(_UPDATE_NAME_AND_METADATA, (name, _dumps(metadata), person_id))
+        elif name:
+            self._conn().execute(_UPDATE_NAME, (name, person_id))
+        elif metadata is not None:
+            self._conn().execute(_UPDATE_METADATA, (_dumps(metadata), person_id))
+        else:
+            return
+        self._version += 1
     
     def delete_person(self, person_id: int):
         """Delete a person from database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("DELETE FROM persons WHERE id = ?", (person_id,))
-        cursor.execute("DELETE FROM detection_logs WHERE person_id = ?", (person_id,))
-        
-        conn.commit()
-        conn.close()
+        with self._transaction() as cursor:
+            cursor.execute("DELETE FROM persons WHERE id = ?", (person_id,))
+            cursor.execute("DELETE FROM detection_logs WHERE person_id = ?", (person_id,))
+        self._version += 1
     
     def get_all_persons(self) -> List[Dict]:
         """Get all persons from database"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = self._conn().execute('''
+            SELECT * FROM persons
+            ORDER BY last_seen DESC, name ASC
+        ''')
+        
+        persons = []
+        for row in cursor.fetchall():
+            person = dict(row)
+            person['face_encoding'] = _blob_to_encoding(person['face_encoding'])
+            person['metadata'] = _load_metadata(person['metadata'])
+            persons.append(person)
+        
+        return persons
+    
+    def get_all_encodings(self) -> Tuple[np.ndarray, List[str], np.ndarray]:
+        """Get ids, names and an (N, 128) float32 matrix of all face encodings"""
+        return self.get_encodings_since(0)
+    
+    def get_encodings_since(self, last_id: int) -> Tuple[np.ndarray, List[str], np.ndarray]:
+        """Get ids, names and encodings of persons with an id above last_id, like get_all_encodings"""
+        rows = self._conn().execute('''
+            SELECT id, name, face_encoding FROM persons
+            WHERE id > ? AND length(face_encoding) > 0
+            ORDER BY id ASC
+        ''', (last_id,)).fetchall()
         
-        cursor.execute('''
-            SELECT * FROM persons 
+        ids = np.array([row['id'] for row in rows], dtype=np.int64)
+        names = [row['name'] for row in rows]
+        if rows:
+            # Join into a bytearray so the matrix is writable and can be patched in place
+            matrix = _blob_to_encoding(bytearray().join(row['face_encoding'] for row in rows)).reshape(len(rows), -1)
+        else:
+            matrix = np.empty((0, 128), dtype=np.float32)
+        
+        return ids, names, matrix
+    
+    def get_gallery_fingerprint(self) -> Tuple[str, int, int]:
+        """Get (epoch, modifications, max id) identifying the stored encodings, to validate cached galleries"""
+        row = self._conn().execute('''
+            SELECT epoch, modifications, (SELECT COALESCE(MAX(id), 0) FROM persons) AS max_id
+            FROM gallery_state
+        ''').fetchone()
+        return row['epoch'], row['modifications'], row['max_id']
+    
+    def get_all_persons_lightweight(self) -> List[Dict]:
+        """Get all persons without their face encodings, for display"""
+        cursor = self._conn().execute('''
+            SELECT id, name, registration_date, last_seen, total_detections, metadata
+            FROM persons
             ORDER BY last_seen DESC, name ASC
         ''')
         
         persons = []
         for row in cursor.fetchall():
             person = dict(row)
-            person['face_encoding'] = json.loads(person['face_encoding'])
-            person['metadata'] = json.loads(person['metadata']) if person['metadata'] else {}
+            person['metadata'] = _load_metadata(person['metadata'])
             persons.append(person)
         
-        conn.close()
         return persons
     
+    def get_recent_persons(self, limit: int = 5) -> List[Dict]:
+        """Get the most recently seen persons without their face encodings"""
+        cursor = self._conn().execute('''
+            SELECT id, name, last_seen, total_detections, metadata
+            FROM persons
+            ORDER BY last_seen DESC, name ASC
+            LIMIT ?
+        ''', (limit,))
+        
+        persons = []
+        for row in cursor.fetchall():
+            person = dict(row)
+            person['metadata'] = _load_metadata(person['metadata'])
+            persons.append(person)
+        
+        return persons
+    
+    def get_top_persons(self, limit: int = 3) -> List[Dict]:
+        """Get the most frequently detected persons"""
+        cursor = self._conn().execute('''
+            SELECT name, total_detections FROM persons
+            ORDER BY total_detections DESC
+            LIMIT ?
+        ''', (limit,))
+        
+        return [dict(row) for row in cursor.fetchall()]
+    
     def get_person_by_id(self, person_id: int) -> Optional[Dict]:
         """Get person by ID"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT * FROM persons WHERE id = ?", (person_id,))
+        cursor = self._conn().execute("SELECT * FROM persons WHERE id = ?", (person_id,))
         row = cursor.fetchone()
         
         if row:
             person = dict(row)
-            person['face_encoding'] = json.loads(person['face_encoding'])
-            person['metadata'] = json.loads(person['metadata']) if person['metadata'] else {}
-            conn.close()
+            person['face_encoding'] = _blob_to_encoding(person['face_encoding'])
+            person['metadata'] = _load_metadata(person['metadata'])
             return person
         
-        conn.close()
         return None
     
     def log_detection(self, person_id: int, confidence: float = None):
         """Log a detection event"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        current_time = datetime.datetime.now().isoformat()
-        
-        # Insert detection log
-        cursor.execute('''
-            INSERT INTO detection_logs (person_id, detection_time, confidence)
-            VALUES (?, ?, ?)
-        ''', (person_id, current_time, confidence))
+        self.log_detections([(person_id, confidence)])
+    
+    def log_detections(self, batch: List[Tuple[int, Optional[float]]]):
+        """Log several detection events in a single transaction"""
+        if not batch:
+            return
         
-        # Update person's last_seen and increment detection count
-        cursor.execute('''
-            UPDATE persons 
-            SET last_seen = ?, total_detections = total_detections + 1
-            WHERE id = ?
-        ''', (current_time, person_id))
+        current_time = int(time.time() * 1000)
+        counts = Counter(person_id for person_id, _ in batch)
         
-        conn.commit()
-        conn.close()
+        with self._transaction() as cursor:
+            # Insert detection logs
+            cursor.executemany('''
+                INSERT INTO detection_logs (person_id, detection_time, confidence)
+                VALUES (?, ?, ?)
+            ''', [(person_id, current_time, confidence) for person_id, confidence in batch])
+            
+            # Update each person's last_seen and detection count once
+            cursor.executemany('''
+                UPDATE persons
+                SET last_seen = ?, total_detections = total_detections + ?
+                WHERE id = ?
+            ''', [(current_time, count, person_id) for person_id, count in counts.items()])
+        self._version += 1
+    
+    def get_counts(self) -> Tuple[int, int]:
+        """Get the number of persons and their total detections"""
+        return tuple(self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(total_detections), 0) FROM persons"
+        ).fetchone())
     
     def get_detection_stats(self, days: int = 7) -> Dict:
         """Get detection statistics for the last N days"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        conn = self._conn()
         
-        cutoff_date = (datetime.datetime.now() - datetime.timedelta(days=days)).isoformat()
+        cutoff_date = int((datetime.datetime.now() - datetime.timedelta(days=days)).timestamp() * 1000)
         
         # Total detections
-        cursor.execute('''
-            SELECT COUNT(*) FROM detection_logs 
+        total_detections = conn.execute('''
+            SELECT COUNT(*) FROM detection_logs
             WHERE detection_time > ?
-        ''', (cutoff_date,))
-        total_detections = cursor.fetchone()[0]
+        ''', (cutoff_date,)).fetchone()[0]
         
         # Unique persons detected
-        cursor.execute('''
-            SELECT COUNT(DISTINCT person_id) FROM detection_logs 
+        unique_persons = conn.execute('''
+            SELECT COUNT(DISTINCT person_id) FROM detection_logs
             WHERE detection_time > ?
-        ''', (cutoff_date,))
-        unique_persons = cursor.fetchone()[0]
+        ''', (cutoff_date,)).fetchone()[0]
         
         # Most frequent visitors
-        cursor.execute('''
-            SELECT p.name, COUNT(*) as count 
+        top_visitors = [tuple(row) for row in conn.execute('''
+            SELECT p.name, COUNT(*) as count
             FROM detection_logs dl
             JOIN persons p ON dl.person_id = p.id
             WHERE dl.detection_time > ?
             GROUP BY p.id
             ORDER BY count DESC
             LIMIT 5
-        ''', (cutoff_date,))
-        top_visitors = cursor.fetchall()
-        
-        conn.close()
+        ''', (cutoff_date,)).fetchall()]
         
         return {
             'total_detections': total_detections,
@@ -208,24 +400,20 @@ class PersonDatabase:
             'top_visitors': top_visitors
         }
     
-    def search_persons(self, query: str) -> List[Dict]:
-        """Search persons by name"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT * FROM persons 
+    def search_persons(self, query: str, prefix: bool = False) -> List[Dict]:
+        """Search persons by name (prefix searches can use the name index)"""
+        pattern = f'{query}%' if prefix else f'%{query}%'
+        cursor = self._conn().execute('''
+            SELECT * FROM persons
             WHERE name LIKE ?
-            ORDER BY name ASC
-        ''', (f'%{query}%',))
+            ORDER BY name COLLATE NOCASE ASC
+        ''', (pattern,))
         
         persons = []
         for row in cursor.fetchall():
             person = dict(row)
-            person['face_encoding'] = json.loads(person['face_encoding'])
-            person['metadata'] = json.loads(person['metadata']) if person['metadata'] else {}
+            person['face_encoding'] = _blob_to_encoding(person['face_encoding'])
+            person['metadata'] = _load_metadata(person['metadata'])
             persons.append(person)
         
-        conn.close()
         return persons
\ No newline at end of file
@@ -1,142 +1,672 @@
 import face_recognition
+import dlib
 import cv2
 import numpy as np
 from typing import List, Tuple, Optional, Dict
 import pickle
 import os
+import multiprocessing
+import concurrent.futures
+import threading
+from functools import lru_cache
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+_cnn_pool = None
+
+# Route resize and color conversion through OpenCL (T-API) when a device is available
+_USE_OPENCL = cv2.ocl.haveOpenCL()
+
+# Maximum Euclidean distance between encodings of the same person
+MATCH_TOLERANCE = 0.6
+
+# Width registration works at; more detail than live detection, since the encoding is stored
+REGISTRATION_WIDTH = 800
+
+# Gallery size from which an HNSW index (if hnswlib is installed) replaces the linear scan
+ANN_MIN_GALLERY = 2000
+
+def detect_faces_cnn(rgb_image) -> List[Tuple[int, int, int, int]]:
+    """Detect faces with the CNN model; module-level so it can run in a worker process"""
+    return face_recognition.face_locations(rgb_image, model="cnn")
+
+if njit is not None:
+    @njit('Tuple((int64[:], float32[:]))(int8[:, ::1], float32[::1], float32[:, ::1], float32)',
+          fastmath=True, cache=True)
+    def _match_nearest(known, scales, probes, max_sq_distance):
+        """Find the nearest int8-quantized known encoding within max_sq_distance for each probe (-1 if none)"""
+        num_probes, dim = probes.shape
+        best_match = np.empty(num_probes, dtype=np.int64)
+        best_sq_distances = np.empty(num_probes, dtype=np.float32)
+        
+        # Serial on purpose: callers share one instance across threads, which
+        # Numba's default workqueue layer can't run parallel regions from
+        for p in range(num_probes):
+            best = -1
+            best_sq = max_sq_distance
+            for n in range(known.shape[0]):
+                scale = scales[n]
+                sq = np.float32(0.0)
+                # Stop summing once this can no longer beat the best (or the tolerance)
+                for k in range(dim):
+                    diff = known[n, k] * scale - probes[p, k]
+                    sq += diff * diff
+                    if sq > best_sq:
+                        break
+                if sq < best_sq or (best == -1 and sq == best_sq):
+                    best_sq = sq
+                    best = n
+            best_match[p] = best
+            best_sq_distances[p] = best_sq if best >= 0 else np.float32(1e30)
+        
+        return best_match, best_sq_distances
+else:
+    _match_nearest = None
+
+def _quantize_rows(matrix) -> Tuple[np.ndarray, np.ndarray]:
+    """Quantize each row of a matrix to int8 with its own float32 scale"""
+    scales = np.abs(matrix).max(axis=1, initial=0) / 127
+    scales[scales == 0] = 1
+    quantized = np.rint(matrix / scales[:, None]).astype(np.int8)
+    return np.ascontiguousarray(quantized), scales.astype(np.float32)
+
+def _face_landmarks(rgb_frame, face_locations) -> dlib.full_object_detections:
+    """Get 5-point landmarks for each face with the predictor face_recognition already loaded"""
+    shapes = dlib.full_object_detections()
+    for top, right, bottom, left in face_locations:
+        shapes.append(face_recognition.api.pose_predictor_5_point(rgb_frame, dlib.rectangle(left, top, right, bottom)))
+    return shapes
+
+def _encode_faces(rgb_frame, face_locations) -> np.ndarray:
+    """Encode all faces in a frame with one ResNet call, as an (N, 128) float32 array"""
+    descriptors = face_recognition.api.face_encoder.compute_face_descriptor(
+        rgb_frame, _face_landmarks(rgb_frame, face_locations), 1
+    )
+    return np.array(descriptors, dtype=np.float32).reshape(-1, 128)
+
+@lru_cache(maxsize=1024)
+def _text_size(label: str, font_scale: float = 0.6, font_thickness: int = 1) -> Tuple[int, int]:
+    """Measure a label once; names and rounded confidences repeat every frame"""
+    return cv2.getTextSize(label, cv2.FONT_HERSHEY_DUPLEX, font_scale, font_thickness)[0]
+
+def _iou_matrix(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    """Intersection over union between every pair of top/right/bottom/left boxes"""
+    top = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    right = np.minimum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    bottom = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    left = np.maximum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+    intersection = np.clip(bottom - top, 0, None) * np.clip(right - left, 0, None)
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 1] - boxes_a[:, 3])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 1] - boxes_b[:, 3])
+    return intersection / np.maximum(area_a[:, None] + area_b[None, :] - intersection, 1)
+
+def _frame_key(frame, rgb: bool) -> Tuple:
+    """Identify a frame cheaply by its buffer, shape and a sparse sample of its pixels"""
+    sample = frame[::max(1, frame.shape[0] // 16), ::max(1, frame.shape[1] // 16)]
+    return (id(frame), frame.shape, frame.ctypes.data, rgb, hash(sample.tobytes()))
+
+def _get_cnn_pool() -> concurrent.futures.ProcessPoolExecutor:
+    """Get the worker pool for the slow CPU CNN detector, creating it on first use"""
+    global _cnn_pool
+    if _cnn_pool is None:
+        # Spawn workers so each loads dlib fresh instead of inheriting it through fork
+        _cnn_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=max(1, (os.cpu_count() or 2) // 2),
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _cnn_pool
+
+def _reset_cnn_pool():
+    """Discard the CNN worker pool, stopping workers still busy with abandoned jobs"""
+    global _cnn_pool
+    pool, _cnn_pool = _cnn_pool, None
+    if pool is None:
+        return
+    # Cancelling a future does not stop a job that is already running
+    for process in list((getattr(pool, '_processes', None) or {}).values()):
+        process.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
 
 class FaceRecognitionSystem:
-    def __init__(self, db, model="hog"):
+    def __init__(self, db, model="hog", detect_width: int = None, cache_dir: str = None):
         self.db = db
-        self.model = model  # "hog" or "cnn"
-        self.known_face_encodings = []
+        self.model = model  # "hog", "cnn" or "cascade" (HOG candidates verified by the CNN)
+        # Where the known faces are cached as .npy files for memory-mapping
+        self.cache_dir = cache_dir or os.path.splitext(db.db_path)[0] + "_gallery"
+        # Width frames are shrunk to before detection; HOG accuracy saturates well below 800px
+        self.detect_width = detect_width or (800 if model == "cnn" else 480)
+        self.known_matrix = np.empty((0, 128), dtype=np.float32)  # (N, 128) face encodings
+        self.known_ids = np.empty(0, dtype=np.int64)
+        self.known_sq_norms = np.empty(0, dtype=np.float32)  # squared L2 norm of each row
         self.known_face_names = []
-        self.known_face_ids = []
+        self._known_int8 = None  # (int8 matrix, row scales) for the compiled matcher, built on demand
+        self._ann_index = None  # hnswlib index labelled by person id for large galleries, built on demand
+        self._tracks = {}  # track id -> box, identity and missed frames, for recognize_tracked
+        self._next_track_id = 0
+        # Per-thread distance buffers for the NumPy matcher and the last frame's detections
+        self._scratch = threading.local()
+        
+        # Use the CNN detector directly only when dlib can run it on the GPU;
+        # face_recognition already loaded it, so share its weights
+        self._cnn_detector = None
+        if getattr(dlib, 'DLIB_USE_CUDA', False):
+            self._cnn_detector = face_recognition.api.cnn_face_detector
+        
         self.load_known_faces()
     
     def load_known_faces(self):
-        """Load known faces from database"""
-        persons = self.db.get_all_persons()
+        """Load known faces, memory-mapping the cached gallery and reading only rows added since"""
+        fingerprint = self.db.get_gallery_fingerprint()
+        cached_fingerprint = self._load_gallery_cache()
         
-        self.known_face_encodings = []
-        self.known_face_names = []
-        self.known_face_ids = []
+        # Registrations only add higher ids, so a cache from the same database
+        # with no modifications since is still valid for the rows it has
+        if cached_fingerprint is not None and cached_fingerprint[:2] != fingerprint[:2]:
+            cached_fingerprint = None
+        if cached_fingerprint is None:
+            self.known_matrix = np.empty((0, 128), dtype=np.float32)
+            self.known_ids = np.empty(0, dtype=np.int64)
+            self.known_face_names = []
+        
+        self.known_sq_norms = np.einsum('ij,ij->i', self.known_matrix, self.known_matrix)
+        self._ann_index = None
+        self._gallery_changed()
         
-        for person in persons:
-            encoding = person['face_encoding']
-            if encoding:
-                self.known_face_encodings.append(np.array(encoding))
-                self.known_face_names.append(person['name'])
-                self.known_face_ids.append(person['id'])
+        if cached_fingerprint != fingerprint:
+            self.load_since(int(self.known_ids[-1]) if len(self.known_ids) else 0)
+            self._save_gallery_cache(fingerprint)
         
-        print(f"Loaded {len(self.known_face_encodings)} known faces from database")
+        print(f"Loaded {len(self.known_matrix)} known faces from database")
     
-    def detect_faces(self, frame):
-        """Detect faces in a frame using specified model"""
-        # Convert BGR to RGB
-        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    def load_since(self, last_id: int) -> int:
+        """Append known faces registered with an id above last_id, returning how many were added"""
+        ids, names, matrix = self.db.get_encodings_since(last_id)
+        if len(ids):
+            self._index_new_faces(matrix, ids)
+            self.known_matrix = np.concatenate([self.known_matrix, matrix])
+            self.known_ids = np.concatenate([self.known_ids, ids])
+            self.known_sq_norms = np.concatenate([self.known_sq_norms, np.einsum('ij,ij->i', matrix, matrix)])
+            self._gallery_changed(appended=True)
+            self.known_face_names.extend(names)
+        return len(ids)
+    
+    def _gallery_changed(self, appended: bool = False):
+        """Drop matcher state derived from the known faces
+        
+        The ANN index is patched by the callers themselves, before they
+        touch the known-face arrays.
+        """
+        self._known_int8 = None
+        if not appended:
+            # Tracked identities may point at removed or renamed people
+            self._tracks.clear()
+    
+    def _index_new_faces(self, matrix: np.ndarray, ids: np.ndarray):
+        """Add faces to an existing ANN index, dropping the index if that fails"""
+        if self._ann_index is None:
+            return
+        try:
+            # Elements marked deleted still hold their slots
+            needed = self._ann_index.get_current_count() + len(ids)
+            if needed > self._ann_index.get_max_elements():
+                self._ann_index.resize_index(max(needed, 2 * self._ann_index.get_max_elements()))
+            self._ann_index.add_items(matrix, ids)
+        except RuntimeError as e:
+            print(f"Error updating ANN index, falling back to exact search: {e}")
+            self._ann_index = None
+    
+    def _build_ann_index(self):
+        """Build an HNSW index over the known faces, labelled by person id"""
+        num_known = len(self.known_matrix)
+        index = hnswlib.Index(space='l2', dim=self.known_matrix.shape[1])
+        index.init_index(max_elements=max(num_known, 1024), ef_construction=200, M=16)
+        index.add_items(self.known_matrix, self.known_ids)
+        index.set_ef(50)
+        return index
+    
+    def _load_gallery_cache(self) -> Optional[Tuple[str, int, int]]:
+        """Load the cached gallery, returning the fingerprint it was saved with"""
+        try:
+            with open(os.path.join(self.cache_dir, "fingerprint")) as f:
+                epoch, modifications, max_id = f.read().split()
+            fingerprint = (epoch, int(modifications), int(max_id))
+            # Copy-on-write keeps the pages shared but the matrix writable
+            known_matrix = np.load(os.path.join(self.cache_dir, "gallery.npy"), mmap_mode='c')
+            known_ids = np.load(os.path.join(self.cache_dir, "ids.npy"))
+            known_face_names = np.load(os.path.join(self.cache_dir, "names.npy")).tolist()
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Ignoring gallery cache: {e}")
+            return None
+        
+        self.known_matrix, self.known_ids, self.known_face_names = known_matrix, known_ids, known_face_names
+        return fingerprint
+    
+    def _save_gallery_cache(self, fingerprint: Tuple[str, int, int]):
+        """Save the known faces as .npy files tagged with the database fingerprint"""
+        if not len(self.known_matrix):
+            return
         
-        # Resize frame for faster processing if it's too large
+        fingerprint_path = os.path.join(self.cache_dir, "fingerprint")
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Drop the fingerprint first so a half-written cache is never trusted
+            if os.path.exists(fingerprint_path):
+                os.remove(fingerprint_path)
+            for filename, array in (
+                ("gallery.npy", self.known_matrix),
+                ("ids.npy", self.known_ids),
+                ("names.npy", np.array(self.known_face_names, dtype=str)),
+            ):
+                path = os.path.join(self.cache_dir, filename)
+                with open(path + ".tmp", 'wb') as f:
+                    np.save(f, array)
+                os.replace(path + ".tmp", path)
+            with open(fingerprint_path, 'w') as f:
+                f.write(" ".join(map(str, fingerprint)))
+        except OSError as e:
+            print(f"Could not save gallery cache: {e}")
+    
+    def _known_index(self, person_id: int) -> Optional[int]:
+        """Get the row of a person in the known faces, if loaded"""
+        matches = np.flatnonzero(self.known_ids == person_id)
+        return int(matches[0]) if matches.size else None
+    
+    def remove_known(self, person_id: int):
+        """Remove one person from the known faces without reloading the database"""
+        idx = self._known_index(person_id)
+        if idx is not None:
+            self.known_matrix = np.delete(self.known_matrix, idx, axis=0)
+            self.known_ids = np.delete(self.known_ids, idx)
+            self.known_sq_norms = np.delete(self.known_sq_norms, idx)
+            if self._ann_index is not None:
+                self._ann_index.mark_deleted(person_id)
+            self._gallery_changed()
+            del self.known_face_names[idx]
+    
+    def update_known(self, person_id: int, name: str = None, encoding=None):
+        """Update one person's name and/or encoding in the known faces"""
+        idx = self._known_index(person_id)
+        if idx is None:
+            return
+        
+        if name:
+            self.known_face_names[idx] = name
+            # Tracks carry the name they were matched under
+            self._tracks.clear()
+        
+        if encoding is not None:
+            if not self.known_matrix.flags.writeable:
+                self.known_matrix = self.known_matrix.copy()
+            self.known_matrix[idx] = encoding
+            self.known_sq_norms[idx] = self.known_matrix[idx] @ self.known_matrix[idx]
+            if self._ann_index is not None:
+                # Re-adding an existing label replaces its vector
+                self._ann_index.add_items(self.known_matrix[idx:idx + 1], [person_id])
+            self._gallery_changed()
+    
+    def _distance_buffer(self, num_faces: int) -> np.ndarray:
+        """Get this thread's reusable (num_faces, N) float32 buffer for squared distances"""
+        buffer = getattr(self._scratch, 'distances', None)
+        num_known = len(self.known_matrix)
+        if buffer is None or buffer.shape[1] != num_known or buffer.shape[0] < num_faces:
+            buffer = np.empty((max(num_faces, 4), num_known), dtype=np.float32)
+            self._scratch.distances = buffer
+        return buffer[:num_faces]
+    
+    def detect_faces_batch(self, rgb_frames, upsample: int = 1, model: str = None) -> List[List[Tuple[int, int, int, int]]]:
+        """Detect faces in same-sized RGB frames, batched on the GPU when CUDA is available"""
+        if (model or self.model) == "cascade":
+            return [self._detect_cascade(rgb_frame, upsample) for rgb_frame in rgb_frames]
+        
+        if self._cnn_detector is None:
+            return [
+                face_recognition.face_locations(rgb_frame, upsample, model=model or self.model)
+                for rgb_frame in rgb_frames
+            ]
+        
+        results = []
+        for rgb_frame, detections in zip(rgb_frames, self._cnn_detector(rgb_frames, upsample, batch_size=len(rgb_frames))):
+            height, width = rgb_frame.shape[:2]
+            results.append([
+                (max(d.rect.top(), 0), min(d.rect.right(), width), min(d.rect.bottom(), height), max(d.rect.left(), 0))
+                for d in detections
+            ])
+        return results
+    
+    def _detect_cascade(self, rgb_frame, upsample: int = 1) -> List[Tuple[int, int, int, int]]:
+        """Find candidate faces with HOG and keep those the CNN confirms in a padded crop"""
         height, width = rgb_frame.shape[:2]
-        if width > 800:
-            scale = 800 / width
-            new_width = 800
+        confirmed = []
+        for top, right, bottom, left in face_recognition.face_locations(rgb_frame, upsample, model="hog"):
+            # Pad by half the box on each side so the CNN sees the whole head
+            pad = (bottom - top) // 2
+            crop_top, crop_left = max(top - pad, 0), max(left - pad, 0)
+            crop = np.ascontiguousarray(rgb_frame[crop_top:min(bottom + pad, height), crop_left:min(right + pad, width)])
+            
+            cnn_locations = self.detect_faces_batch([crop], upsample, model="cnn")[0]
+            if cnn_locations:
+                # Keep the CNN's box, which is usually tighter than HOG's
+                t, r, b, l = max(cnn_locations, key=lambda loc: (loc[2] - loc[0]) * (loc[1] - loc[3]))
+                confirmed.append((t + crop_top, r + crop_left, b + crop_top, l + crop_left))
+        
+        return confirmed
+    
+    def _preprocess(self, frame, rgb: bool = False, max_width: int = None) -> Tuple[np.ndarray, float]:
+        """Convert a frame to RGB and shrink it to at most max_width (default detect_width)
+        
+        Returns the processed frame and the factor that maps its
+        coordinates back to the original frame.
+        """
+        max_width = max_width or self.detect_width
+        
+        # Resize first if it's too large, so the color conversion touches fewer pixels
+        height, width = frame.shape[:2]
+        scale_factor = 1.0
+        use_umat = _USE_OPENCL and (width > max_width or not rgb)
+        if use_umat:
+            frame = cv2.UMat(frame)
+        if width > max_width:
+            scale = max_width / width
+            new_width = max_width
             new_height = int(height * scale)
-            rgb_frame = cv2.resize(rgb_frame, (new_width, new_height))
+            frame = cv2.resize(frame, (new_width, new_height), interpolation=cv2.INTER_AREA)
+            scale_factor = width / max_width
+        
+        # Convert BGR to RGB
+        rgb_frame = frame if rgb else cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        if use_umat:
+            rgb_frame = rgb_frame.get()
+        
+        return rgb_frame, scale_factor
+    
+    def _detect_preprocessed(self, frame, rgb: bool = False, max_width: int = None) -> Tuple[np.ndarray, float, List[Tuple[int, int, int, int]]]:
+        """Preprocess a frame and find faces in it, reusing the result when called again on the same frame"""
+        # Kept per thread, since sessions share this instance
+        key = (_frame_key(frame, rgb), max_width)
+        last_detection = getattr(self._scratch, 'last_detection', None)
+        if last_detection is not None and last_detection[0] == key:
+            return last_detection[1:]
+        
+        rgb_frame, scale_factor = self._preprocess(frame, rgb, max_width)
+        face_locations = self.detect_faces_batch([rgb_frame])[0]
+        self._scratch.last_detection = (key, rgb_frame, scale_factor, face_locations)
+        return rgb_frame, scale_factor, face_locations
+    
+    def detect_faces(self, frame, allow_fallback_cnn: bool = True, rgb: bool = False, max_width: int = None):
+        """Detect faces in a BGR frame (or an RGB one when rgb=True)
         
-        # Detect faces
-        face_locations = face_recognition.face_locations(rgb_frame, model=self.model)
+        Uses the GPU CNN detector when available and the configured model
+        otherwise, on a copy shrunk to max_width (default detect_width).
+        If a HOG pass finds nothing and allow_fallback_cnn is set, the CNN
+        model is retried on a half-size copy in a worker process.
+        """
+        # Detect faces, shared with recognize_faces on the same frame
+        _, scale_factor, face_locations = self._detect_preprocessed(frame, rgb, max_width)
         
-        # Scale locations back if we resized
-        if width > 800:
-            scale_factor = width / 800
+        # Scale locations back if we resized, always into a new list the caller owns
+        if scale_factor != 1.0:
             face_locations = [
                 (int(top * scale_factor), int(right * scale_factor), 
                  int(bottom * scale_factor), int(left * scale_factor))
                 for (top, right, bottom, left) in face_locations
             ]
+        else:
+            face_locations = list(face_locations)
+        
+        if not face_locations and allow_fallback_cnn and self._cnn_detector is None and self.model == "hog":
+            # Keep the slow CPU CNN off the caller's thread
+            full_rgb_frame = frame if rgb else cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            small_frame = cv2.resize(full_rgb_frame, (0, 0), fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)
+            try:
+                future = _get_cnn_pool().submit(detect_faces_cnn, small_frame)
+                face_locations = [
+                    tuple(coord * 2 for coord in location)
+                    for location in future.result(timeout=120)
+                ]
+            except concurrent.futures.TimeoutError:
+                _reset_cnn_pool()
+                print("CNN face detection timed out")
+            except concurrent.futures.BrokenExecutor as e:
+                _reset_cnn_pool()
+                print(f"CNN face detection worker crashed: {e}")
+            except Exception as e:
+                print(f"Error in CNN face detection: {e}")
         
         return face_locations
     
-    def recognize_faces(self, frame) -> List[Dict]:
-        """Recognize faces in a frame"""
-        # Convert BGR to RGB
-        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    def recognize_faces(self, frame, rgb: bool = False, require_encoding: bool = False) -> Dict:
+        """Recognize faces in a BGR frame (or an RGB one when rgb=True)
         
-        # Resize for faster processing if needed
-        height, width = rgb_frame.shape[:2]
-        original_size = (height, width)
-        
-        if width > 800:
-            scale = 800 / width
-            new_width = 800
-            new_height = int(height * scale)
-            rgb_frame = cv2.resize(rgb_frame, (new_width, new_height))
+        Returns parallel per-face arrays: 'ids' (-1 for unknown faces),
+        'confidences', 'locations' as (N, 4) top/right/bottom/left rows,
+        and a 'names' list. With require_encoding, an (N, 128) 'encodings'
+        array is added; otherwise faces are only encoded when someone is
+        registered to match them against.
+        """
+        rgb_frame, scale_factor, face_locations = self._detect_preprocessed(frame, rgb)
+        return self.recognize_from_preprocessed(rgb_frame, scale_factor, require_encoding, face_locations)
+    
+    def recognize_from_preprocessed(self, rgb_frame, scale_factor: float = 1.0, require_encoding: bool = False,
+                                    face_locations: List[Tuple[int, int, int, int]] = None) -> Dict:
+        """Recognize faces in an RGB frame already returned by _preprocess
         
+        Locations are multiplied by scale_factor to map them back to the
+        original frame. Faces are detected unless face_locations are given.
+        Returns the same structure as recognize_faces.
+        """
         # Find all faces in the frame
-        face_locations = face_recognition.face_locations(rgb_frame, model=self.model)
-        face_encodings = face_recognition.face_encodings(rgb_frame, face_locations)
-        
-        recognized_faces = []
-        
-        for (top, right, bottom, left), face_encoding in zip(face_locations, face_encodings):
-            # Scale back if we resized
-            if width > 800:
-                scale_factor = original_size[1] / 800
-                top, right, bottom, left = [
-                    int(coord * scale_factor) 
-                    for coord in [top, right, bottom, left]
+        if face_locations is None:
+            face_locations = self.detect_faces_batch([rgb_frame])[0]
+        
+        # Every face is unknown with an empty gallery, so skip the encoder unless asked for
+        num_faces = len(face_locations)
+        if num_faces and (len(self.known_matrix) or require_encoding):
+            face_encodings = _encode_faces(rgb_frame, face_locations)
+        else:
+            face_encodings = np.empty((num_faces, 128), dtype=np.float32)
+        
+        return self._match_faces(face_locations, face_encodings, scale_factor, require_encoding)
+    
+    def recognize_tracked(self, frame, rgb: bool = False, max_missed: int = 5, min_iou: float = 0.3) -> Dict:
+        """Recognize faces in consecutive video frames, reusing identities of tracked faces
+        
+        Faces are tracked by box overlap with the previous frame, so only
+        new faces and tracks that are still unknown get encoded and matched.
+        Tracks unseen for more than max_missed frames are dropped. Returns
+        the same structure as recognize_faces. Tracks live on the instance,
+        so use one FaceRecognitionSystem per video stream.
+        """
+        rgb_frame, scale_factor, face_locations = self._detect_preprocessed(frame, rgb)
+        boxes = np.array(face_locations, dtype=np.int32).reshape(-1, 4)
+        num_faces = len(boxes)
+        
+        # Greedily pair boxes with tracks, highest overlap first
+        track_ids = list(self._tracks)
+        assigned = [None] * num_faces
+        if num_faces and track_ids:
+            iou = _iou_matrix(boxes, np.array([self._tracks[t]['box'] for t in track_ids]))
+            used = set()
+            for flat in np.argsort(iou, axis=None)[::-1]:
+                box_idx, track_idx = divmod(int(flat), len(track_ids))
+                if iou[box_idx, track_idx] < min_iou:
+                    break
+                if assigned[box_idx] is None and track_idx not in used:
+                    assigned[box_idx] = track_ids[track_idx]
+                    used.add(track_idx)
+        
+        ids = np.full(num_faces, -1, dtype=np.int64)
+        confidences = np.zeros(num_faces, dtype=np.float32)
+        names = ["Unknown"] * num_faces
+        
+        # Encode and match only faces without a known identity
+        pending = []
+        for i, track_id in enumerate(assigned):
+            track = self._tracks.get(track_id)
+            if track is not None and track['id'] != -1:
+                ids[i], confidences[i], names[i] = track['id'], track['confidence'], track['name']
+            else:
+                pending.append(i)
+        if pending:
+            recognized = self.recognize_from_preprocessed(rgb_frame, face_locations=[face_locations[i] for i in pending])
+            ids[pending] = recognized['ids']
+            confidences[pending] = recognized['confidences']
+            for i, name in zip(pending, recognized['names']):
+                names[i] = name
+        
+        # Age out tracks that were not seen, then record this frame's boxes
+        for track_id in set(track_ids) - set(assigned):
+            self._tracks[track_id]['missed'] += 1
+            if self._tracks[track_id]['missed'] > max_missed:
+                del self._tracks[track_id]
+        for i, track_id in enumerate(assigned):
+            if track_id is None:
+                track_id = self._next_track_id
+                self._next_track_id += 1
+            self._tracks[track_id] = {
+                'box': boxes[i],
+                'id': int(ids[i]),
+                'name': names[i],
+                'confidence': float(confidences[i]),
+                'missed': 0
+            }
+        
+        # Scale back if we resized
+        locations = boxes
+        if scale_factor != 1.0:
+            locations = (boxes * scale_factor).astype(np.int32)
+        
+        return {
+            'ids': ids,
+            'confidences': confidences,
+            'locations': locations,
+            'names': names
+        }
+    
+    def recognize_batch(self, frames, rgb: bool = False, batch_size: int = 16) -> List[Dict]:
+        """Recognize faces in same-sized frames, batching detection and encoding on the GPU
+        
+        Returns one recognize_faces result per frame. With CUDA, up to
+        batch_size frames go through the CNN detector and the ResNet
+        encoder in one forward pass each; otherwise frames are recognized
+        one at a time.
+        """
+        preprocessed = [self._preprocess(frame, rgb) for frame in frames]
+        if self._cnn_detector is None:
+            return [self.recognize_from_preprocessed(rgb_frame, scale_factor) for rgb_frame, scale_factor in preprocessed]
+        
+        results = []
+        for start in range(0, len(preprocessed), batch_size):
+            chunk = preprocessed[start:start + batch_size]
+            rgb_frames = [rgb_frame for rgb_frame, _ in chunk]
+            batch_locations = self.detect_faces_batch(rgb_frames)
+            
+            # Landmarks for every face, then one encoder pass over every frame's faces
+            batch_encodings = [np.empty((len(face_locations), 128), dtype=np.float32) for face_locations in batch_locations]
+            if len(self.known_matrix) and any(batch_locations):
+                batch_shapes = [
+                    _face_landmarks(rgb_frame, face_locations)
+                    for rgb_frame, face_locations in zip(rgb_frames, batch_locations)
                 ]
+                descriptors = face_recognition.api.face_encoder.compute_face_descriptor(rgb_frames, batch_shapes, 1)
+                batch_encodings = [np.array(d, dtype=np.float32).reshape(-1, 128) for d in descriptors]
             
-            name = "Unknown"
-            person_id = None
-            confidence = 0
+            for (_, scale_factor), face_locations, face_encodings in zip(chunk, batch_locations, batch_encodings):
+                results.append(self._match_faces(face_locations, face_encodings, scale_factor))
+        
+        return results
+    
+    def _match_faces(self, face_locations, face_encodings: np.ndarray, scale_factor: float = 1.0,
+                     require_encoding: bool = False) -> Dict:
+        """Match encoded faces against the known faces and build a recognize_faces result"""
+        num_faces = len(face_locations)
+        ids = np.full(num_faces, -1, dtype=np.int64)
+        confidences = np.zeros(num_faces, dtype=np.float32)
+        names = ["Unknown"] * num_faces
+        locations = np.array(face_locations, dtype=np.int32).reshape(num_faces, 4)
+        
+        # Scale back if we resized
+        if scale_factor != 1.0:
+            locations = (locations * scale_factor).astype(np.int32)
+        
+        if num_faces and len(self.known_matrix):
+            probes = face_encodings
             
-            if self.known_face_encodings:
-                # Compare with known faces
-                matches = face_recognition.compare_faces(
-                    self.known_face_encodings, 
-                    face_encoding,
-                    tolerance=0.6
+            if hnswlib is not None and len(self.known_matrix) >= ANN_MIN_GALLERY:
+                # Approximate nearest neighbour, O(log N) per face; hnswlib's l2 is squared
+                if self._ann_index is None:
+                    self._ann_index = self._build_ann_index()
+                labels, sq_distances = self._ann_index.knn_query(probes, k=1)
+                # Labels are person ids; known_ids is ascending, so search for their rows
+                best_match = np.searchsorted(self.known_ids, labels[:, 0].astype(np.int64))
+                best_sq_distances = sq_distances[:, 0]
+            elif _match_nearest is not None:
+                # Compiled loop with early exit over an int8 copy, a quarter of the bytes;
+                # the slack keeps faces quantization pushes just past the tolerance
+                if self._known_int8 is None:
+                    self._known_int8 = _quantize_rows(self.known_matrix)
+                best_match, best_sq_distances = _match_nearest(
+                    *self._known_int8, probes, np.float32(MATCH_TOLERANCE ** 2 + 0.01)
                 )
-                
-                if True in matches:
-                    # Find the best match
-                    face_distances = face_recognition.face_distance(
-                        self.known_face_encodings, 
-                        face_encoding
-                    )
-                    best_match_index = np.argmin(face_distances)
-                    
-                    if matches[best_match_index]:
-                        name = self.known_face_names[best_match_index]
-                        person_id = self.known_face_ids[best_match_index]
-                        confidence = 1 - face_distances[best_match_index]
+                # Rescore each winner against its exact encoding, so the threshold
+                # and the confidence shown carry no quantization error
+                found = np.flatnonzero(best_match >= 0)
+                diff = self.known_matrix[best_match[found]] - probes[found]
+                best_sq_distances[found] = np.einsum('ij,ij->i', diff, diff)
+            else:
+                # Compare all faces with all known faces at once:
+                # |k - q|^2 = |k|^2 + |q|^2 - 2 k.q, one (K, N) matrix product
+                # built up in place in a reused buffer
+                sq_distances = self._distance_buffer(num_faces)
+                np.matmul(probes, self.known_matrix.T, out=sq_distances)
+                sq_distances *= -2
+                sq_distances += self.known_sq_norms
+                sq_distances += np.einsum('ij,ij->i', probes, probes)[:, None]
+                best_match = sq_distances.argmin(axis=1)
+                best_sq_distances = np.maximum(sq_distances[np.arange(num_faces), best_match], 0)
             
-            recognized_faces.append({
-                'location': (top, right, bottom, left),
-                'name': name,
-                'person_id': person_id,
-                'confidence': confidence
-            })
+            # Threshold on the squared distance; only matches need the sqrt
+            matched = np.flatnonzero(best_sq_distances <= MATCH_TOLERANCE ** 2)
+            ids[matched] = self.known_ids[best_match[matched]]
+            confidences[matched] = 1 - np.sqrt(best_sq_distances[matched])
+            for i in matched:
+                names[i] = self.known_face_names[best_match[i]]
         
-        return recognized_faces
+        result = {
+            'ids': ids,
+            'confidences': confidences,
+            'locations': locations,
+            'names': names
+        }
+        if require_encoding:
+            result['encodings'] = face_encodings
+        return result
     
-    def register_new_face(self, frame, name: str, metadata: Dict = None) -> bool:
-        """Register a new face from a frame"""
-        # Convert BGR to RGB
-        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    def register_new_face(self, frame, name: str, metadata: Dict = None, rgb: bool = False,
+                          face_locations: List[Tuple[int, int, int, int]] = None) -> bool:
+        """Register a new face from a BGR frame (or an RGB one when rgb=True)
         
-        # Resize for better performance
-        height, width = rgb_frame.shape[:2]
-        if width > 800:
-            scale = 800 / width
-            new_width = 800
-            new_height = int(height * scale)
-            rgb_frame = cv2.resize(rgb_frame, (new_width, new_height))
+        Pass face_locations from detect_faces (in frame coordinates) to
+        register a face found there, including by the CNN fallback;
+        otherwise faces are detected again.
+        """
+        # Registration keeps more detail than detection, since the encoding is stored
+        rgb_frame, scale_factor = self._preprocess(frame, rgb, max_width=REGISTRATION_WIDTH)
         
-        # Find faces in the frame
-        face_locations = face_recognition.face_locations(rgb_frame, model=self.model)
+        # Find faces in the frame, or map the given ones onto the resized copy
+        if face_locations is None:
+            face_locations = self.detect_faces_batch([rgb_frame])[0]
+        else:
+            face_locations = [tuple(int(coord / scale_factor) for coord in location) for location in face_locations]
         
         if not face_locations:
             print("No faces found for registration")
@@ -149,18 +679,19 @@ class FaceRecognitionSystem:
         best_face_idx = np.argmax(face_sizes)
         
         try:
-            face_encoding = face_recognition.face_encodings(
-                rgb_frame, 
-                [face_locations[best_face_idx]]
-            )[0]
+            face_encoding = _encode_faces(rgb_frame, [face_locations[best_face_idx]])[0]
             
             # Add to database
-            person_id = self.db.add_person(name, face_encoding.tolist(), metadata)
+            person_id = self.db.add_person(name, face_encoding.astype('<f4').tobytes(), metadata)
             
             # Update known faces
-            self.known_face_encodings.append(face_encoding)
+            encoding = face_encoding.astype(np.float32)
+            self._index_new_faces(encoding[None], np.array([person_id]))
+            self.known_matrix = np.vstack([self.known_matrix, encoding])
+            self.known_ids = np.append(self.known_ids, person_id)
+            self.known_sq_norms = np.append(self.known_sq_norms, encoding @ encoding)
+            self._gallery_changed(appended=True)
             self.known_face_names.append(name)
-            self.known_face_ids.append(person_id)
             
             print(f"Successfully registered {name}")
             return True
@@ -168,41 +699,44 @@ class FaceRecognitionSystem:
             print(f"Error registering face: {e}")
             return False
     
-    def draw_face_boxes(self, frame, recognized_faces: List[Dict]):
-        """Draw bounding boxes and labels on frame"""
-        for face in recognized_faces:
-            top, right, bottom, left = face['location']
-            name = face['name']
-            confidence = face['confidence']
-            
-            # Draw box
-            color = (0, 255, 0) if name != "Unknown" else (0, 0, 255)
-            thickness = 2
-            cv2.rectangle(frame, (left, top), (right, bottom), color, thickness)
-            
-            # Draw label background
-            label_height = 30
-            cv2.rectangle(
-                frame, 
-                (left, bottom - label_height), 
-                (right, bottom), 
-                color, 
-                cv2.FILLED
-            )
-            
-            # Draw label text
+    def draw_face_boxes(self, frame, recognized_faces: Dict):
+        """Draw bounding boxes and labels from recognize_faces on an RGB frame"""
+        locations = recognized_faces['locations']
+        if not len(locations):
+            return frame
+        
+        label_height = 30
+        font_scale = 0.6
+        font_thickness = 1
+        top, right, bottom, left = locations.T
+        # Corners of every box and label background, as (N, 4, 2) polygons
+        boxes = np.stack([left, top, right, top, right, bottom, left, bottom], axis=1).reshape(-1, 4, 2)
+        label_boxes = boxes.copy()
+        label_boxes[:, :2, 1] = bottom[:, None] - label_height
+        
+        # Draw boxes and label backgrounds with one call per color
+        known = np.array([name != "Unknown" for name in recognized_faces['names']])
+        for mask, color in ((known, (0, 255, 0)), (~known, (255, 0, 0))):
+            if mask.any():
+                cv2.polylines(frame, list(boxes[mask]), True, color, 2)
+                cv2.fillPoly(frame, list(label_boxes[mask]), color)
+        
+        # Draw label text
+        for (top, right, bottom, left), name, confidence in zip(
+            locations.tolist(),
+            recognized_faces['names'],
+            recognized_faces['confidences'].tolist()
+        ):
             if confidence > 0:
                 label = f"{name} ({confidence:.1%})"
             else:
                 label = name
             
-            font_scale = 0.6
-            font_thickness = 1
-            text_size = cv2.getTextSize(label, cv2.FONT_HERSHEY_DUPLEX, font_scale, font_thickness)[0]
+            text_width, text_height = _text_size(label, font_scale, font_thickness)
             
             # Center text in label box
-            text_x = left + (right - left - text_size[0]) // 2
-            text_y = bottom - (label_height - text_size[1]) // 2
+            text_x = left + (right - left - text_width) // 2
+            text_y = bottom - (label_height - text_height) // 2
             
             cv2.putText(
                 frame, 